@@ -56,18 +56,47 @@ from flask import (Blueprint, request, flash, render_template,
                    redirect, url_for, make_response)
 from flask.ext.login import login_required
 import os
-import io
+import hashlib
 import shutil
 import re
 import redis
 import rq
 import json
-from .tasks import render_task
+import math
+import time
+from rq.registry import StartedJobRegistry
+from sqlalchemy.exc import IntegrityError
+try:
+    from sqlalchemy.dialects.postgresql import insert as _pg_insert
+except ImportError:
+    _pg_insert = None
+try:
+    from sqlalchemy.dialects.sqlite import insert as _sqlite_insert
+except ImportError:
+    _sqlite_insert = None
+from .tasks import (render_task, warm_template_task, gc_task, read_metadata,
+                    to_timestamp, LOG_KEY, STATS_KEY, STATS_LIMIT,
+                    TEMPLATE_DIR, TEMPLATE_CACHE, TEMPLATE_SLUG)
+from .storage import get_store, ARTIFACT_EXTS
 
 KwDocs = Blueprint('KwDocs', __name__, template_folder='templates')
 app.config['REDIS_URL'] = 'redis://localhost:6379/0'
+# Artifact store URL (file:///path or s3://bucket/prefix?endpoint=URL).
+# If unset, PDFs and aux files are written next to the sources in DOCPATH.
+app.config.setdefault('KWDOCS_STORE', None)
+# Queue wait (in seconds) and worker utilization that worker count
+# recommendations aim for, and the window (in seconds) used for throughput
+# statistics.
+app.config.setdefault('KWDOCS_TARGET_WAIT', 60)
+app.config.setdefault('KWDOCS_TARGET_UTILIZATION', 0.8)
+app.config.setdefault('KWDOCS_STATS_WINDOW', 900)
 redisdb = redis.StrictRedis.from_url(app.config['REDIS_URL'])
 q = rq.Queue(name='kwdocs', connection=redisdb)
+#: Number of rows written per statement by bulk metadata writes.
+BULK_CHUNK = 500
+#: Minimum interval between artifact store collections, in seconds.
+GC_INTERVAL = 3600
+store = get_store(app.config['KWDOCS_STORE'])
 
 
 class Document(db.Model):
@@ -94,15 +123,76 @@ class Document(db.Model):
 
 def _fetch_from_file(slug):
     """Fetch metadata from file in a hacky way."""
-    data = {'title': '', 'author': '', 'date': ''}
-    with io.open(os.path.join(app.config['DOCPATH'], slug, slug + '.tex'), encoding='utf-8') as fh:
-        for line in fh:
-            m = re.match(r'\\([a-zA-Z]*){(.*)}', line, flags=re.UNICODE)
-            if (m and m.groups()[0] in ('title', 'author', 'date') and
-                    m.groups()[1] != ''):
-                data.update({m.groups()[0]: m.groups()[1]})
+    return read_metadata(os.path.join(app.config['DOCPATH'], slug,
+                                      slug + '.tex'))
 
-    return data
+
+def _list_templates():
+    """List template names and whether their caches are up to date."""
+    tpldir = os.path.join(app.config['DOCPATH'], TEMPLATE_DIR)
+    return {f[:-4]: _template_cache(f[:-4])
+            for f in sorted(os.listdir(tpldir)) if f.endswith('.tex')}
+
+
+def _template_cache(name):
+    """Check if the cache of a template is up to date."""
+    tpldir = os.path.join(app.config['DOCPATH'], TEMPLATE_DIR)
+    try:
+        with open(os.path.join(tpldir, name + '.tex'), 'rb') as fh:
+            src = fh.read()
+    except IOError:
+        return False
+    if store:
+        return (store.digest(TEMPLATE_SLUG, name + '.cache.tex') ==
+                hashlib.sha256(src).hexdigest())
+
+    cachedir = os.path.join(tpldir, TEMPLATE_CACHE, name)
+    try:
+        with open(os.path.join(cachedir, name + '.tex'), 'rb') as fh:
+            cached = fh.read()
+    except IOError:
+        return False
+    return src == cached and os.path.exists(os.path.join(cachedir,
+                                                         'meta.json'))
+
+
+def _install_template_cache(name, slug, dstdir):
+    """Copy the cache of a template to a new document.
+
+    Returns the cached metadata.
+    """
+    if store:
+        for ext in ARTIFACT_EXTS:
+            store.copy(TEMPLATE_SLUG, name + '.cache' + ext, slug, slug + ext)
+        return json.loads(store.get(TEMPLATE_SLUG,
+                                    name + '.cache.json').decode('utf-8'))
+
+    cachedir = os.path.join(app.config['DOCPATH'], TEMPLATE_DIR,
+                            TEMPLATE_CACHE, name)
+    for ext in ARTIFACT_EXTS:
+        path = os.path.join(cachedir, name + ext)
+        if os.path.exists(path):
+            shutil.copy(path, os.path.join(dstdir, slug + ext))
+    with open(os.path.join(cachedir, 'meta.json')) as fh:
+        return json.load(fh)
+
+
+def _warm_template(name):
+    """Enqueue a template cache build, unless one is pending."""
+    job_id = '__template__.{0}'.format(name)
+    job = q.fetch_job(job_id)
+    if job is not None and job.get_status() in ('queued', 'started'):
+        return job
+    if store:
+        # Workers fetch templates from the store, not from DOCPATH.
+        store.upload(TEMPLATE_SLUG, name + '.tex',
+                     os.path.join(app.config['DOCPATH'], TEMPLATE_DIR,
+                                  name + '.tex'))
+    return q.enqueue_call(func=warm_template_task,
+                          args=(app.config['REDIS_URL'],
+                                app.config['DOCPATH'], name,
+                                app.config['KWDOCS_STORE']),
+                          job_id=job_id)
 
 
 @KwDocs.route("/")
@@ -164,57 +254,176 @@ def reload(slug):
     return redirect(url_for('.doc', slug=slug))
 
 
+def _chunks(seq, size):
+    """Split a list into chunks of at most ``size`` items."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+
+def _upsert_statement(table):
+    """Get an INSERT ... ON CONFLICT (slug) DO UPDATE statement, if the
+    database dialect supports it, or None."""
+    insert = {'postgresql': _pg_insert, 'sqlite': _sqlite_insert}.get(
+        db.session.get_bind().dialect.name)
+    if insert is None:
+        return None
+    stmt = insert(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.slug],
+        set_={'title': stmt.excluded.title, 'author': stmt.excluded.author,
+              'date': stmt.excluded.date})
+
+
+def _insert_or_update(ins, upd, row, updparams):
+    """Insert a row, or update it if it exists.  Returns True if updated."""
+    savepoint = db.session.begin_nested()
+    try:
+        db.session.execute(ins, row)
+        savepoint.commit()
+        return False
+    except IntegrityError:
+        savepoint.rollback()
+        db.session.execute(upd, updparams([row['slug']]))
+        return True
+
+
+def _bulk_write(meta):
+    """Synchronize the Document table with ``meta`` (slug → metadata).
+
+    Existing rows are compared with ``meta`` and only the differences are
+    written, using batched statements.  Rows for slugs that are not in
+    ``meta`` are deleted.  New rows are upserted, so documents added
+    concurrently (by ``new_doc``, ``reload``…) do not make the reload
+    fail.  Returns counts of inserted, updated, deleted and unchanged
+    rows.  The caller is responsible for committing.
+    """
+    table = Document.__table__
+    fields = ('title', 'author', 'date')
+    existing = {r.slug: r for r in db.session.query(
+        Document.slug, Document.title, Document.author, Document.date)}
+
+    inserts = []
+    updates = []
+    unchanged = 0
+    for slug, data in meta.items():
+        row = existing.get(slug)
+        if row is None:
+            inserts.append(dict(slug=slug, **data))
+        elif any(getattr(row, f) != data[f] for f in fields):
+            updates.append(slug)
+        else:
+            unchanged += 1
+    deletes = [slug for slug in existing if slug not in meta]
+    counts = {'inserted': len(inserts), 'updated': len(updates),
+              'deleted': len(deletes), 'unchanged': unchanged}
+
+    def updparams(slugs):
+        return [{'b_slug': slug, 'b_title': meta[slug]['title'],
+                 'b_author': meta[slug]['author'],
+                 'b_date': meta[slug]['date']} for slug in slugs]
+
+    upsert = _upsert_statement(table)
+    ins = table.insert()
+    upd = table.update().where(table.c.slug == db.bindparam('b_slug')).values(
+        title=db.bindparam('b_title'), author=db.bindparam('b_author'),
+        date=db.bindparam('b_date'))
+    for chunk in _chunks(inserts, BULK_CHUNK):
+        if upsert is not None:
+            db.session.execute(upsert, chunk)
+            continue
+        # No upsert in this dialect: if a row appeared since we looked,
+        # roll back to the savepoint and redo the chunk row by row.
+        savepoint = db.session.begin_nested()
+        try:
+            db.session.execute(ins, chunk)
+            savepoint.commit()
+        except IntegrityError:
+            savepoint.rollback()
+            for row in chunk:
+                if _insert_or_update(ins, upd, row, updparams):
+                    counts['inserted'] -= 1
+                    counts['updated'] += 1
+    for chunk in _chunks(updates, BULK_CHUNK):
+        db.session.execute(upd, updparams(chunk))
+    for chunk in _chunks(deletes, BULK_CHUNK):
+        db.session.execute(table.delete().where(table.c.slug.in_(chunk)))
+
+    return counts
+
+
 @KwDocs.route("/__bulk__/reload/")
 @login_required
 def bulk_reload():
     """Reload all the metadata."""
-    status = {}
-    newdocs = {}
-    dbd = Document.query.all()
-    dbdocs = {d.slug: d for d in dbd}
     fsdocs = os.listdir(app.config['DOCPATH'])
     fsdocs.remove('__ARCHIVE')
-    for f in fsdocs:
-        if f in dbdocs:
-            fsdocs.remove(f)
-
-    docs = dbdocs.keys() + fsdocs
-
-    for slug in docs:
+    meta = {}
+    for slug in fsdocs:
         try:
-            data = _fetch_from_file(slug)
+            meta[slug] = _fetch_from_file(slug)
         except:
-            status[slug] = 0b01
-            db.session.delete(dbdocs[slug])
-
-        if slug in dbdocs:
-            dbdocs[slug].title = data['title']
-            dbdocs[slug].author = data['author']
-            dbdocs[slug].date = data['date']
-            status[slug] = 0b11
-        else:
-            newdocs[slug] = Document(slug,
-                                     data['title'],
-                                     data['author'],
-                                     data['date'])
-            status[slug] = 0b10
-
-    for d in dbdocs.values() + newdocs.values():
-        db.session.add(d)
+            pass  # not a document; removed from the DB if present
 
+    counts = _bulk_write(meta)
     db.session.commit()
-    flash('Documents reloaded successfully.', 'success')
+    flash('Documents reloaded successfully: {inserted} inserted, {updated} '
+          'updated, {deleted} deleted, {unchanged} '
+          'unchanged.'.format(**counts), 'success')
     return redirect(url_for('.doclist'))
 
 
+def _schedule_gc():
+    """Enqueue an artifact store collection, at most once per GC_INTERVAL."""
+    if store and redisdb.set('kwdocs:gc', 1, ex=GC_INTERVAL, nx=True):
+        q.enqueue_call(func=gc_task,
+                       args=(app.config['REDIS_URL'],
+                             app.config['KWDOCS_STORE']),
+                       job_id='__gc__')
+
+
+def _enqueue_render(slug):
+    """Enqueue the two render runs of a document, unless they exist."""
+    r1_job = q.fetch_job('{0}.r1'.format(slug))
+    r2_job = q.fetch_job('{0}.r2'.format(slug))
+
+    if not r1_job and not r2_job:
+        if store:
+            # Workers fetch sources from the store, not from DOCPATH.
+            try:
+                store.upload(slug, slug + '.tex',
+                             os.path.join(app.config['DOCPATH'], slug,
+                                          slug + '.tex'))
+            except IOError:
+                pass  # the render task reports missing documents
+        r1_job = q.enqueue_call(
+            func=render_task, args=(app.config['REDIS_URL'],
+                                    app.config['DOCPATH'], slug,
+                                    app.config['KWDOCS_STORE']),
+            job_id='{0}.r1'.format(slug))
+        r2_job = q.enqueue_call(
+            func=render_task, args=(app.config['REDIS_URL'],
+                                    app.config['DOCPATH'], slug,
+                                    app.config['KWDOCS_STORE']),
+            job_id='{0}.r2'.format(slug), depends_on=r1_job)
+        _schedule_gc()
+
+    return r1_job, r2_job
+
+
 @KwDocs.route("/<slug>/view/")
 @login_required
 def view(slug):
     """View a PDF."""
     try:
-        with open(os.path.join(app.config['DOCPATH'], slug, slug + '.pdf'),
-                  'rb') as fh:
-            resp = make_response(fh.read(), 200)
+        if store:
+            data = store.get(slug, slug + '.pdf')
+            if data is None:
+                raise IOError('PDF not in store')
+        else:
+            with open(os.path.join(app.config['DOCPATH'], slug,
+                                   slug + '.pdf'), 'rb') as fh:
+                data = fh.read()
+        resp = make_response(data, 200)
         resp.headers['Content-Type'] = 'application/pdf'
         return resp
     except IOError:
@@ -225,18 +434,7 @@ def view(slug):
 @login_required
 def api_render(slug):
     """Rebuild the site (internally)."""
-    r1_job = q.fetch_job('{0}.r1'.format(slug))
-    r2_job = q.fetch_job('{0}.r2'.format(slug))
-
-    if not r1_job and not r2_job:
-        r1_job = q.enqueue_call(
-            func=render_task, args=(app.config['REDIS_URL'],
-                                    app.config['DOCPATH'], slug),
-            job_id='{0}.r1'.format(slug))
-        r2_job = q.enqueue_call(
-            func=render_task, args=(app.config['REDIS_URL'],
-                                    app.config['DOCPATH'], slug),
-            job_id='{0}.r2'.format(slug), depends_on=r1_job)
+    r1_job, r2_job = _enqueue_render(slug)
 
     d = json.dumps({'1': r1_job.meta, '2': r2_job.meta})
 
@@ -250,22 +448,23 @@ def api_render(slug):
     return d
 
 
+@KwDocs.route('/<slug>/render/<int:run>/log.txt')
+@login_required
+def render_log(slug, run):
+    """Show the raw log of a render run."""
+    log = redisdb.get(LOG_KEY.format('{0}.r{1}'.format(slug, run)))
+    if log is None:
+        return make_response('No log available.', 404,
+                             {'Content-Type': 'text/plain; charset=utf-8'})
+    return make_response(log, 200,
+                         {'Content-Type': 'text/plain; charset=utf-8'})
+
+
 @KwDocs.route("/<slug>/render/")
 @login_required
 def render(slug):
     """Render a document."""
-    r1_job = q.fetch_job('{0}.r1'.format(slug))
-    r2_job = q.fetch_job('{0}.r2'.format(slug))
-
-    if not r1_job and not r2_job:
-        r1_job = q.enqueue_call(
-            func=render_task, args=(app.config['REDIS_URL'],
-                                    app.config['DOCPATH'], slug),
-            job_id='{0}.r1'.format(slug))
-        r2_job = q.enqueue_call(
-            func=render_task, args=(app.config['REDIS_URL'],
-                                    app.config['DOCPATH'], slug),
-            job_id='{0}.r2'.format(slug), depends_on=r1_job)
+    r1_job, r2_job = _enqueue_render(slug)
 
     return render_template('render.html', slug=slug, title='Rendering {0}'.format(slug), permalink=url_for('.render', slug=slug))
 
@@ -297,6 +496,13 @@ def delete(slug):
                 shutil.rmtree(os.path.join(app.config['DOCPATH'], slug))
             except:
                 flash('Directory removal failed.', 'error')
+
+            if store:
+                try:
+                    store.delete(slug)
+                    _schedule_gc()
+                except:
+                    flash('Removal from the artifact store failed.', 'error')
             return redirect(url_for('.doclist', slug=slug), 302)
         else:
             return redirect(url_for('.doc', slug=slug), 302)
@@ -343,18 +549,192 @@ def act(slug):
 @login_required
 def new_doc():
     """Creating a new document."""
+    templates = _list_templates()
     if request.method == 'GET' or request.form.get('act') != 'create':
-        return render_template('new.html', title='New document', permalink=url_for('.new_doc'))
+        return render_template('new.html', templates=templates, title='New document', permalink=url_for('.new_doc'))
     else:
         slug = request.form['slug'].strip()
-        src = os.path.join(app.config['DOCPATH'], 'template', 'template.tex')
+        name = request.form.get('template', 'template')
+        if name not in templates:
+            flash('No such template.', 'error')
+            return redirect(url_for('.new_doc'), 302)
         dstdir = os.path.join(app.config['DOCPATH'], slug)
-        dst = os.path.join(dstdir, slug + '.tex')
         try:
             os.mkdir(dstdir)
-            shutil.copy(src, dst)
+            shutil.copy(os.path.join(app.config['DOCPATH'], TEMPLATE_DIR,
+                                     name + '.tex'),
+                        os.path.join(dstdir, slug + '.tex'))
         except:
             flash('Failed to create new document.', 'error')
             return redirect(url_for('.new_doc'), 302)
-        reload(slug)
+
+        d = None
+        if _template_cache(name):
+            # Start from the template’s rendered state: the aux files make
+            # the first render converge in one run, and the PDF is
+            # viewable right away.
+            try:
+                d = _install_template_cache(name, slug, dstdir)
+            except:
+                pass  # the cache changed or failed; start cold
+        if d is None:
+            try:
+                _warm_template(name)
+            except:
+                pass  # the cache is only an optimization
+            try:
+                d = _fetch_from_file(slug)
+            except:
+                flash('Failed to read the new document’s metadata.', 'error')
+                return redirect(url_for('.doc', slug=slug), 302)
+
+        # The slug may still be in the DB, without files (see doclist).
+        doc = Document.query.filter_by(slug=slug).first()
+        if doc:
+            doc.title = d['title']
+            doc.author = d['author']
+            doc.date = d['date']
+        else:
+            doc = Document(slug, d['title'], d['author'], d['date'])
+        db.session.add(doc)
+        db.session.commit()
         return redirect(url_for('.doc', slug=slug), 302)
+
+
+@KwDocs.route("/__templates__/", methods=['GET', 'POST'])
+@login_required
+def templates():
+    """List and create templates.
+
+    POST with ``act=create`` and a ``name`` creates a template, either from
+    an uploaded ``tex`` file or from the document given as ``slug``.  POST
+    with ``act=warm`` and a ``name`` rebuilds a template’s cache.
+    """
+    if request.method == 'POST':
+        name = request.form.get('name', '').strip()
+        if not re.match(r'^[a-zA-Z0-9_-]+$', name):
+            flash('Invalid template name.', 'error')
+            return redirect(url_for('.templates'), 302)
+        if request.form.get('act') == 'create':
+            if name in _list_templates():
+                flash('Template {0} already exists.'.format(name), 'error')
+                return redirect(url_for('.templates'), 302)
+            dst = os.path.join(app.config['DOCPATH'], TEMPLATE_DIR,
+                               name + '.tex')
+            try:
+                if request.files.get('tex'):
+                    request.files['tex'].save(dst)
+                else:
+                    slug = request.form['slug'].strip()
+                    if (not re.match(r'^[a-zA-Z0-9_-]+$', slug) or
+                            not Document.query.filter_by(slug=slug).first()):
+                        flash('No such document.', 'error')
+                        return redirect(url_for('.templates'), 302)
+                    shutil.copy(os.path.join(app.config['DOCPATH'], slug,
+                                             slug + '.tex'), dst)
+            except:
+                flash('Failed to create template.', 'error')
+                return redirect(url_for('.templates'), 302)
+            flash('Template {0} created.'.format(name), 'success')
+        elif name not in _list_templates():
+            flash('No such template.', 'error')
+            return redirect(url_for('.templates'), 302)
+        try:
+            _warm_template(name)
+        except:
+            flash('Failed to start building the template cache.', 'error')
+        return redirect(url_for('.templates'), 302)
+
+    return render_template('templates.html', templates=_list_templates(), title='Templates', permalink=url_for('.templates'))
+
+
+def _job_stats(stats, span):
+    """Summarize job statistics recorded over ``span`` seconds."""
+    done = len(stats)
+    failed = len([e for e in stats if not e['status']])
+    waits = [e['wait'] for e in stats if e['wait'] is not None]
+    return {'done': done, 'failed': failed,
+            'per_minute': done * 60.0 / span,
+            'failure_rate': (float(failed) / done) if done else None,
+            'mean_duration': (sum(e['duration'] for e in stats) / done)
+            if done else None,
+            'mean_wait': (sum(waits) / len(waits)) if waits else None}
+
+
+def _worker_status():
+    """Get the status of the render queue and workers."""
+    now = time.time()
+    window = app.config['KWDOCS_STATS_WINDOW']
+    target = app.config['KWDOCS_TARGET_WAIT']
+    utilization = app.config['KWDOCS_TARGET_UTILIZATION']
+
+    workers = [{'name': w.name, 'state': w.get_state(),
+                'job': w.get_current_job_id()}
+               for w in rq.Worker.all(connection=redisdb)
+               if q.name in w.queue_names()]
+
+    inflight = []
+    for job_id in StartedJobRegistry(q.name, connection=redisdb).get_job_ids():
+        job = q.fetch_job(job_id)
+        if job is None or job.started_at is None:
+            continue
+        inflight.append({'id': job_id,
+                         'elapsed': now - to_timestamp(job.started_at)})
+
+    stats = []
+    entries = redisdb.lrange(STATS_KEY, 0, -1)
+    for entry in entries:
+        entry = json.loads(entry.decode('utf-8'))
+        if entry['finished'] < now - window:
+            break  # the list is sorted, newest first
+        stats.append(entry)
+    # If the list was trimmed inside the window, rates are computed over
+    # the span it still covers.
+    span = window
+    if len(entries) >= STATS_LIMIT and len(stats) == len(entries):
+        span = max(now - stats[-1]['finished'], 1)
+
+    jobs = _job_stats(stats, span)
+    renders = _job_stats([e for e in stats
+                          if e.get('kind', 'render') == 'render'], span)
+    queued = q.count
+
+    # Little’s law: steady load keeps rate × duration workers busy, and
+    # needs more (running at the target utilization) to keep waits short;
+    # the backlog needs queued × duration / target more to be served
+    # within target.  All jobs on the queue count, not only renders.
+    service = jobs['mean_duration'] or 0
+    rate = jobs['per_minute'] / 60
+    needed = rate * service / utilization + queued * service / target
+    recommended = int(math.ceil(needed))
+    if (queued or inflight) and recommended < 1:
+        recommended = 1
+
+    return {
+        'queue': {'queued': queued, 'started': len(inflight)},
+        'workers': {'live': len(workers),
+                    'busy': len([w for w in workers
+                                 if w['state'] == 'busy']),
+                    'list': workers},
+        'inflight': inflight,
+        'throughput': {'window': span, 'jobs': jobs, 'renders': renders},
+        'recommendation': {'target_wait': target,
+                           'target_utilization': utilization,
+                           'workers': recommended},
+    }
+
+
+@KwDocs.route('/__workers__/status.json')
+@login_required
+def api_workers():
+    """Show the render queue and worker status (for autoscalers)."""
+    resp = make_response(json.dumps(_worker_status()), 200)
+    resp.headers['Content-Type'] = 'application/json'
+    return resp
+
+
+@KwDocs.route('/__workers__/')
+@login_required
+def workers():
+    """Show the render queue and worker status."""
+    return render_template('workers.html', status=_worker_status(), title='Render workers', permalink=url_for('.workers'))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+# Flask-KwDocs v0.2.0
+# A LaTeX document management system for Flask.
+# Copyright © 2013–2015, Chris Warrick.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions, and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions, and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the author of this software nor the names of
+#    contributors to this software may be used to endorse or promote
+#    products derived from this software without specific prior written
+#    consent.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE COPYRIGHT
+# OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL,
+# SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT
+# LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE,
+# DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY
+# THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+    flask-kwdocs.storage
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Artifact stores for KwDocs.
+
+    :Copyright: © 2013–2015, Chris Warrick.
+    :License: BSD (see /LICENSE).
+"""
+
+# Artifacts are content-addressed: blobs live under ``objects/<sha256>`` and
+# ``refs/<slug>/<name>`` holds the hash of the current version of a file.
+# Objects that are no longer referenced are removed by :meth:`Store.collect`.
+
+from __future__ import unicode_literals
+
+import calendar
+import hashlib
+import io
+import os
+import tempfile
+import time
+
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+try:
+    import boto3
+    import botocore.exceptions
+except ImportError:
+    boto3 = None
+
+#: Files that are uploaded after a render and fetched before the next one.
+ARTIFACT_EXTS = ('.pdf', '.aux', '.toc', '.out', '.log')
+#: Unreferenced objects younger than this (in seconds) are not collected,
+#: so that objects written just before their refs are not removed.
+GC_GRACE = 3600
+
+
+class Store(object):
+
+    """Base class for artifact stores."""
+
+    def _read(self, key):
+        """Read a raw key, returning None if it does not exist."""
+        raise NotImplementedError
+
+    def _write(self, key, data):
+        """Write a raw key."""
+        raise NotImplementedError
+
+    def _delete(self, key):
+        """Delete a raw key, if it exists."""
+        raise NotImplementedError
+
+    def _list(self, prefix):
+        """List raw keys starting with ``prefix``, with their mtimes."""
+        raise NotImplementedError
+
+    def put(self, slug, name, data):
+        """Store a file for a document, returning its hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        # Always (re)write the object, which also refreshes its mtime, so
+        # that a concurrent collect() cannot remove it before it is
+        # referenced.
+        self._write('objects/' + digest, data)
+        self._write('refs/{0}/{1}'.format(slug, name), digest.encode('ascii'))
+        return digest
+
+    def digest(self, slug, name):
+        """Get the hash of a file for a document, or None."""
+        digest = self._read('refs/{0}/{1}'.format(slug, name))
+        if digest is None:
+            return None
+        return digest.decode('ascii')
+
+    def get(self, slug, name):
+        """Get a file for a document, or None if it does not exist."""
+        digest = self.digest(slug, name)
+        if digest is None:
+            return None
+        return self._read('objects/' + digest)
+
+    def copy(self, srcslug, srcname, dstslug, dstname):
+        """Copy a file between documents, without copying its data.
+
+        Returns False if the source file does not exist.
+        """
+        digest = self.digest(srcslug, srcname)
+        if digest is None:
+            return False
+        self._write('refs/{0}/{1}'.format(dstslug, dstname),
+                    digest.encode('ascii'))
+        return True
+
+    def remove(self, slug, name):
+        """Remove a file of a document."""
+        self._delete('refs/{0}/{1}'.format(slug, name))
+
+    def delete(self, slug):
+        """Remove all files of a document."""
+        for key, _ in list(self._list('refs/{0}/'.format(slug))):
+            self._delete(key)
+
+    def fetch(self, slug, name, path):
+        """Download a file to ``path``, returning False if it is missing."""
+        data = self.get(slug, name)
+        if data is None:
+            return False
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return True
+
+    def upload(self, slug, name, path):
+        """Upload a file from ``path``."""
+        with open(path, 'rb') as fh:
+            return self.put(slug, name, fh.read())
+
+    def collect(self, grace=GC_GRACE):
+        """Remove unreferenced objects.  Returns the number removed."""
+        # Objects are listed before refs, so objects written after the
+        # listing are never considered.  A put() of a long-unreferenced
+        # object racing with this can still lose its object; the next
+        # render of that document uploads it again.
+        objects = list(self._list('objects/'))
+        live = set()
+        for key, _ in self._list('refs/'):
+            digest = self._read(key)
+            if digest is not None:
+                live.add(digest.decode('ascii'))
+        limit = time.time() - grace
+        removed = 0
+        for key, mtime in objects:
+            if key[len('objects/'):] not in live and mtime < limit:
+                self._delete(key)
+                removed += 1
+        return removed
+
+
+class LocalStore(Store):
+
+    """A store in a local (or shared) directory."""
+
+    def __init__(self, root):
+        """Initialize the store."""
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def _read(self, key):
+        try:
+            with io.open(self._path(key), 'rb') as fh:
+                return fh.read()
+        except IOError:
+            return None
+
+    def _write(self, key, data):
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError:
+            pass
+        # Write to a temporary file first, so that readers never see a
+        # half-written ref or object.
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(data)
+        os.rename(tmp, path)
+
+    def _delete(self, key):
+        try:
+            os.unlink(self._path(key))
+        except OSError:
+            pass
+
+    def _list(self, prefix):
+        base = self._path(prefix.rstrip('/'))
+        for root, dirs, files in os.walk(base):
+            for f in files:
+                path = os.path.join(root, f)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                try:
+                    yield key, os.path.getmtime(path)
+                except OSError:
+                    pass  # removed in the meantime
+
+
+class S3Store(Store):
+
+    """A store in an S3-compatible bucket (AWS, MinIO…)."""
+
+    def __init__(self, bucket, prefix='', endpoint=None):
+        """Initialize the store."""
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for S3 artifact stores.')
+        self.bucket = bucket
+        self.prefix = prefix.strip('/')
+        self.client = boto3.client('s3', endpoint_url=endpoint)
+
+    def _key(self, key):
+        if self.prefix:
+            return self.prefix + '/' + key
+        return key
+
+    def _read(self, key):
+        try:
+            obj = self.client.get_object(Bucket=self.bucket,
+                                         Key=self._key(key))
+        except botocore.exceptions.ClientError:
+            return None
+        return obj['Body'].read()
+
+    def _write(self, key, data):
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key),
+                               Body=data)
+
+    def _delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def _list(self, prefix):
+        strip = len(self._key(''))
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket,
+                                       Prefix=self._key(prefix)):
+            for obj in page.get('Contents', []):
+                yield (obj['Key'][strip:],
+                       calendar.timegm(obj['LastModified'].utctimetuple()))
+
+
+def get_store(url):
+    """Get a store for an URL.
+
+    ``file:///path/to/dir`` gives a :class:`LocalStore`,
+    ``s3://bucket/prefix?endpoint=http://minio:9000`` gives a
+    :class:`S3Store`.  If ``url`` is empty, None is returned.
+    """
+    if not url:
+        return None
+    u = urlparse(url)
+    if u.scheme == 'file':
+        return LocalStore(u.path)
+    elif u.scheme == 's3':
+        endpoint = parse_qs(u.query).get('endpoint', [None])[0]
+        return S3Store(u.netloc, u.path, endpoint)
+    else:
+        raise ValueError('Unknown artifact store: {0}'.format(url))
@@ -48,43 +48,318 @@
 from __future__ import unicode_literals
 
 import subprocess
+import calendar
+import io
+import json
 import os
+import re
+import shutil
+import tempfile
+import time
 from rq import get_current_job
 from redis import StrictRedis
+from .storage import get_store, ARTIFACT_EXTS
 
+#: The lualatex command (without the file name), for renders and templates.
+LUALATEX = ('lualatex', '--halt-on-error', '--interaction=nonstopmode')
+#: Redis key holding the raw log of a render job.
+LOG_KEY = 'kwdocs:log:{0}'
+#: How long raw logs are kept, in seconds.
+LOG_TTL = 86400
+#: How many entries of each kind are kept in a log summary.
+SUMMARY_LIMIT = 10
 
-def render_task(dburl, docpath, slug):
-    """Render a document."""
+#: Redis list of recent render statistics (newest first).
+STATS_KEY = 'kwdocs:stats'
+#: How many render statistics are kept.
+STATS_LIMIT = 1000
+#: Directory (under DOCPATH) holding templates, as ``<name>.tex``.
+TEMPLATE_DIR = 'template'
+#: Directory (under TEMPLATE_DIR) holding pre-built template caches.
+TEMPLATE_CACHE = '__CACHE'
+#: Reserved artifact store slug holding templates (``<name>.tex``) and
+#: their caches (``<name>.cache.<ext>``), if a store is used.
+TEMPLATE_SLUG = '__TEMPLATES'
+
+_meta_re = re.compile(r'\\([a-zA-Z]*){(.*)}', flags=re.UNICODE)
+_error_re = re.compile(r'^! (.*)$')
+_errline_re = re.compile(r'^l\.(\d+)')
+_warning_re = re.compile(r'^((?:LaTeX|Package|Class)(?: [^ ]+)? Warning: .*)$')
+_undefined_re = re.compile(r"(Reference|Citation) `(.+?)' on page \d+ "
+                           r"undefined")
+_overfull_re = re.compile(r'^(Overfull \\[hv]box .*)$')
+_pages_re = re.compile(r'^Output written on .* \((\d+) pages?')
+
+
+class LogParser(object):
+
+    """A streaming parser for lualatex output.
+
+    Lines are fed one by one; :attr:`summary` holds a compact summary of
+    errors, warnings, overfull boxes, undefined references and the page
+    count, with at most ``SUMMARY_LIMIT`` entries of each kind.
+    """
+
+    def __init__(self):
+        """Initialize the parser."""
+        self.summary = {'errors': [], 'warnings': [], 'overfull': [],
+                        'undefined': [], 'pages': None,
+                        'counts': {'errors': 0, 'warnings': 0,
+                                   'overfull': 0, 'undefined': 0}}
+        self._pending = None
+
+    def _add(self, kind, entry):
+        self.summary['counts'][kind] += 1
+        if len(self.summary[kind]) < SUMMARY_LIMIT:
+            self.summary[kind].append(entry)
+
+    def feed(self, line):
+        """Parse a line of output.  Returns True if the summary changed."""
+        line = line.rstrip()
+        m = _error_re.match(line)
+        if m:
+            self._pending = {'message': m.group(1), 'line': None}
+            self._add('errors', self._pending)
+            return True
+        m = _errline_re.match(line)
+        if m and self._pending is not None:
+            self._pending['line'] = int(m.group(1))
+            self._pending = None
+            return True
+        m = _undefined_re.search(line)
+        if m:
+            self._add('undefined', '{0} {1}'.format(m.group(1).lower(),
+                                                    m.group(2)))
+            return True
+        m = _warning_re.match(line)
+        if m:
+            self._add('warnings', m.group(1))
+            return True
+        m = _overfull_re.match(line)
+        if m:
+            self._add('overfull', m.group(1))
+            return True
+        m = _pages_re.match(line)
+        if m:
+            self.summary['pages'] = int(m.group(1))
+            return True
+        return False
+
+
+def read_metadata(path):
+    """Read document metadata from a .tex file in a hacky way."""
+    data = {'title': '', 'author': '', 'date': ''}
+    with io.open(path, encoding='utf-8') as fh:
+        for line in fh:
+            m = _meta_re.match(line)
+            if (m and m.groups()[0] in ('title', 'author', 'date') and
+                    m.groups()[1] != ''):
+                data.update({m.groups()[0]: m.groups()[1]})
+
+    return data
+
+
+def _fetch_sources(store, slug, scratch):
+    """Fetch the source and the previous run’s aux files into scratch."""
+    if not store.fetch(slug, slug + '.tex',
+                       os.path.join(scratch, slug + '.tex')):
+        return False
+    for ext in ARTIFACT_EXTS:
+        if ext not in ('.pdf', '.log'):
+            store.fetch(slug, slug + ext, os.path.join(scratch, slug + ext))
+    return True
+
+
+def _upload_artifacts(store, slug, scratch):
+    """Upload the artifacts of a render."""
+    for ext in ARTIFACT_EXTS:
+        path = os.path.join(scratch, slug + ext)
+        if os.path.exists(path):
+            store.upload(slug, slug + ext, path)
+
+
+def to_timestamp(dt):
+    """Convert a datetime to a UNIX timestamp.
+
+    rq uses naive UTC datetimes in older versions and aware ones in newer
+    versions; both are handled.
+    """
+    return calendar.timegm(dt.utctimetuple()) + dt.microsecond / 1e6
+
+
+def _record_stats(db, job, started, status, kind):
+    """Record the statistics of a finished job.
+
+    ``kind`` is ``'render'``, ``'template'`` or ``'gc'``.
+    """
+    wait = None
+    if job.enqueued_at:
+        wait = started - to_timestamp(job.enqueued_at)
+    db.lpush(STATS_KEY, json.dumps({
+        'id': job.id, 'kind': kind, 'status': status,
+        'finished': time.time(),
+        'duration': time.time() - started, 'wait': wait}))
+    db.ltrim(STATS_KEY, 0, STATS_LIMIT - 1)
+
+
+def render_task(dburl, docpath, slug, storeurl=None):
+    """Render a document.
+
+    If ``storeurl`` is set, the document is rendered in a scratch directory
+    using sources from the artifact store, and the results are uploaded
+    there.  Otherwise, it is rendered in place, under ``docpath``.
+    """
+    started = time.time()
+    db = StrictRedis.from_url(dburl)
+    job = get_current_job(db)
+    store = get_store(storeurl)
     oldcwd = os.getcwd()
+    scratch = None
     try:
-        os.chdir(os.path.join(docpath, slug))
+        if store:
+            scratch = tempfile.mkdtemp(prefix='kwdocs-')
+            if not _fetch_sources(store, slug, scratch):
+                raise IOError('Document not found in store.')
+            os.chdir(scratch)
+        else:
+            os.chdir(os.path.join(docpath, slug))
     except:
-        db = StrictRedis.from_url(dburl)
-        job = get_current_job(db)
-        job.meta.update({'out': 'Document not found.', 'return': 127, 'status': False})
+        if scratch:
+            shutil.rmtree(scratch, True)
+        parser = LogParser()
+        parser.feed('! Document not found.')
+        job.meta.update({'summary': parser.summary, 'return': 127,
+                         'status': False})
+        job.save()
+        _record_stats(db, job, started, False, 'render')
         return 127
 
-    db = StrictRedis.from_url(dburl)
-    job = get_current_job(db)
-    job.meta.update({'out': '', 'milestone': 0, 'total': 1, 'return': None,
-                     'status': None})
+    parser = LogParser()
+    logkey = LOG_KEY.format(job.id)
+    db.delete(logkey)
+    job.meta.update({'summary': parser.summary, 'milestone': 0, 'total': 1,
+                     'return': None, 'status': None})
     job.save()
 
-    p = subprocess.Popen(('lualatex', '--halt-on-error', slug + '.tex'),
-                         stdout=subprocess.PIPE)
+    try:
+        # TeX wraps its output at max_print_line (79) characters, which
+        # would split messages across lines; raise it so that LogParser
+        # sees every message on one line.
+        p = subprocess.Popen(LUALATEX + (slug + '.tex',),
+                             stdout=subprocess.PIPE,
+                             env=dict(os.environ, max_print_line='10000'))
 
-    out = []
+        # The raw log goes to a separate key, fetched only on demand; job
+        # meta (polled by clients) only holds the summary.
+        for nl in iter(p.stdout.readline, b''):
+            db.append(logkey, nl)
+            if parser.feed(nl.decode('utf-8', 'replace')):
+                job.save()
+        p.wait()
 
-    while p.poll() is None:
-        nl = p.stdout.readline()
-        out.append(nl)
-        job.meta.update({'out': ''.join(out), 'return': None,
-                         'status': None})
+        if store:
+            _upload_artifacts(store, slug, scratch)
+        job.meta.update({'return': p.returncode, 'status':
+                         p.returncode == 0})
         job.save()
-
-    out = ''.join(out)
-    job.meta.update({'out': ''.join(out), 'return': p.returncode, 'status':
-                     p.returncode == 0})
-    job.save()
-    os.chdir(oldcwd)
+    except:
+        # lualatex missing, store errors, job timeouts…
+        _record_stats(db, job, started, False, 'render')
+        raise
+    finally:
+        db.expire(logkey, LOG_TTL)
+        os.chdir(oldcwd)
+        if scratch:
+            shutil.rmtree(scratch, True)
+    _record_stats(db, job, started, p.returncode == 0, 'render')
     return p.returncode
+
+
+def gc_task(dburl, storeurl):
+    """Remove unreferenced objects from the artifact store."""
+    started = time.time()
+    db = StrictRedis.from_url(dburl)
+    try:
+        removed = get_store(storeurl).collect()
+    except:
+        _record_stats(db, get_current_job(db), started, False, 'gc')
+        raise
+    _record_stats(db, get_current_job(db), started, True, 'gc')
+    return removed
+
+
+def _save_template_cache(store, name, scratch, meta):
+    """Upload a template cache to the artifact store."""
+    for ext in ARTIFACT_EXTS:
+        path = os.path.join(scratch, name + ext)
+        if ext != '.log' and os.path.exists(path):
+            store.upload(TEMPLATE_SLUG, name + '.cache' + ext, path)
+        else:
+            store.remove(TEMPLATE_SLUG, name + '.cache' + ext)
+    store.put(TEMPLATE_SLUG, name + '.cache.json', meta.encode('utf-8'))
+    # The cache is valid when its source matches the template, so the
+    # source goes last.
+    store.upload(TEMPLATE_SLUG, name + '.cache.tex',
+                 os.path.join(scratch, name + '.tex'))
+
+
+def warm_template_task(dburl, docpath, name, storeurl=None):
+    """Build the cache of a template.
+
+    The template is rendered twice in a scratch directory, and its source,
+    aux files, PDF and metadata are saved in ``TEMPLATE_CACHE/<name>`` (or,
+    if ``storeurl`` is set, in the artifact store, under ``TEMPLATE_SLUG``),
+    so that new documents start from a warm state.
+    """
+    started = time.time()
+    db = StrictRedis.from_url(dburl)
+    try:
+        returncode = _build_template_cache(docpath, name, get_store(storeurl))
+    except:
+        _record_stats(db, get_current_job(db), started, False, 'template')
+        raise
+    _record_stats(db, get_current_job(db), started, returncode == 0,
+                  'template')
+    return returncode
+
+
+def _build_template_cache(docpath, name, store):
+    """Build the cache of a template (see warm_template_task)."""
+    tpldir = os.path.join(docpath, TEMPLATE_DIR)
+    cachedir = os.path.join(tpldir, TEMPLATE_CACHE, name)
+    scratch = tempfile.mkdtemp(prefix='kwdocs-')
+    src = os.path.join(scratch, name + '.tex')
+    try:
+        if store:
+            if not store.fetch(TEMPLATE_SLUG, name + '.tex', src):
+                return 127
+        else:
+            shutil.copy(os.path.join(tpldir, name + '.tex'), src)
+        with open(os.devnull, 'wb') as devnull:
+            for run in range(2):
+                returncode = subprocess.call(LUALATEX + (name + '.tex',),
+                                             cwd=scratch, stdout=devnull)
+                if returncode != 0:
+                    return returncode
+        meta = json.dumps(read_metadata(src))
+
+        if store:
+            _save_template_cache(store, name, scratch, meta)
+            return 0
+
+        # Build in a new directory and swap it in, so that new_doc never
+        # sees a half-built cache.
+        newdir = cachedir + '.new'
+        shutil.rmtree(newdir, True)
+        os.makedirs(newdir)
+        for ext in ('.tex',) + ARTIFACT_EXTS:
+            path = os.path.join(scratch, name + ext)
+            if ext != '.log' and os.path.exists(path):
+                shutil.copy(path, newdir)
+        with open(os.path.join(newdir, 'meta.json'), 'w') as fh:
+            fh.write(meta)
+        shutil.rmtree(cachedir, True)
+        os.rename(newdir, cachedir)
+        return 0
+    finally:
+        shutil.rmtree(scratch, True)